@@ -1,16 +1,230 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from numba import njit, prange
+
+# Numba types the series (stored volume, evaporation, inflow and demand) may
+# be stored as. Curves and capacities are always float64.
+_SERIES_TYPES = ("f8", "f4")
+
+# One year of the weekly seasonal sinusoid used by generate_streamflow.
+_SEASONAL_SIN = np.sin(2. * np.pi / 52 * np.arange(52))
+
+
+@njit("f8(f8, f8[::1], f8[::1], f8[::1])", cache=True)
+def _calculate_area(stored_volume, storages, slopes, intercepts):
+    """Evaluate the piecewise-linear storage vs. area curve, stored as the
+    slope and intercept of each of its segments.
+
+    Arguments:
+        stored_volume {float} -- current stored volume
+        storages {1D numpy array} -- storages of the curve points
+        slopes {1D numpy array} -- area slope of each curve segment
+        intercepts {1D numpy array} -- area intercept of each curve segment
+
+    Returns:
+        float -- reservoir area
+    """
+    segment = np.searchsorted(storages, stored_volume, side="right") - 1
+    segment = min(max(segment, 0), len(slopes) - 1)
+
+    return slopes[segment] * stored_volume + intercepts[segment]
+
+
+@njit("UniTuple(f8, 3)(f8, f8, f8, f8, f8, f8[::1], f8[::1], f8[::1], f8)",
+      cache=True)
+def _step(stored_volume, upstream_flow, evaporation_rate, inflow, demand,
+          storages, slopes, intercepts, capacity):
+    """Compiled mass balance of one reservoir over one week.
+
+    Arguments:
+        stored_volume {float} -- stored volume in the previous week
+        upstream_flow {float} -- release from upstream reservoir
+        evaporation_rate {float} -- evaporation of the week
+        inflow {float} -- inflow of the week
+        demand {float} -- demand of the week
+        storages {1D numpy array} -- storages of the storage vs. area curve
+        slopes {1D numpy array} -- area slope of each curve segment
+        intercepts {1D numpy array} -- area intercept of each curve segment
+        capacity {float} -- reservoir capacity
+
+    Returns:
+        float, float, float -- reservoir release, unfulfilled demand and
+                               new stored volume
+    """
+    evaporation = evaporation_rate *\
+        _calculate_area(stored_volume, storages, slopes, intercepts)
+    new_stored_volume = stored_volume + upstream_flow + inflow -\
+        evaporation + demand
+
+    # Branchless clamp to [0, capacity], overflow is released downstream.
+    release = max(new_stored_volume - capacity, 0.)
+    unfulfilled_demand = max(-new_stored_volume, 0.)
+    new_stored_volume = min(max(new_stored_volume, 0.), capacity)
+
+    return release, unfulfilled_demand, new_stored_volume
+
+
+@njit(["f8(i8, f8[::1], {0}[::1], {0}[::1], {0}[::1], {0}[::1], f8[::1], "
+       "f8[::1], f8[::1], f8)".format(t) for t in _SERIES_TYPES],
+      cache=True, fastmath=True)
+def _run_reservoir(n_weeks, releases, stored_volume, evaporations, inflows,
+                   demands, storages, slopes, intercepts, capacity):
+    """Compiled mass balance of one reservoir over all weeks.
+
+    Arguments:
+        n_weeks {int} -- number of weeks to simulate
+        releases {1D numpy array} -- releases of the upstream reservoir,
+            overwritten in place by the releases of this reservoir
+        stored_volume {1D numpy array} -- stored volume series, updated in
+            place
+        evaporations {1D numpy array} -- evaporation series
+        inflows {1D numpy array} -- inflow series
+        demands {1D numpy array} -- demand series
+        storages {1D numpy array} -- storages of the storage vs. area curve
+        slopes {1D numpy array} -- area slope of each curve segment
+        intercepts {1D numpy array} -- area intercept of each curve segment
+        capacity {float} -- reservoir capacity
+
+    Returns:
+        float -- unfulfilled demand in the last week
+    """
+    unfulfilled_demand = 0.
+
+    # Keep the running stored volume in a local instead of re-reading it.
+    volume = stored_volume[0]
+    for week in range(1, n_weeks):
+        releases[week], unfulfilled_demand, volume = _step(
+            volume, releases[week], evaporations[week], inflows[week],
+            demands[week], storages, slopes, intercepts, capacity)
+        stored_volume[week] = volume
+
+    return unfulfilled_demand
+
+
+@njit(["f8(i8, {0}[:, ::1], {0}[:, ::1], {0}[:, ::1], {0}[:, ::1], "
+       "f8[:, ::1], f8[:, ::1], f8[:, ::1], f8[::1])".format(t)
+       for t in _SERIES_TYPES], cache=True, fastmath=True)
+def _run_mass_balance(n_weeks, stored_volumes, evaporations, inflows,
+                      demands, storages, slopes, intercepts, capacities):
+    """Compiled mass balance of reservoirs in series.
+
+    Arguments:
+        n_weeks {int} -- number of weeks to simulate
+        stored_volumes {2D numpy array} -- stored volumes, one row per
+            reservoir, updated in place
+        evaporations {2D numpy array} -- evaporations, one row per reservoir
+        inflows {2D numpy array} -- inflows, one row per reservoir
+        demands {2D numpy array} -- demands, one row per reservoir
+        storages {2D numpy array} -- curve storages, one row per reservoir
+        slopes {2D numpy array} -- curve segment slopes, one row per
+            reservoir
+        intercepts {2D numpy array} -- curve segment intercepts, one row per
+            reservoir
+        capacities {1D numpy array} -- reservoir capacities
+
+    Returns:
+        float -- unfulfilled demand of the last reservoir in the last week
+    """
+    unfulfilled_demand = 0.
+
+    # Reservoir r only depends on the releases of reservoir r - 1, so
+    # reservoirs are simulated one after the other over all weeks, with each
+    # one overwriting the releases it received by the ones it makes.
+    releases = np.zeros(n_weeks)
+    for r in range(stored_volumes.shape[0]):
+        unfulfilled_demand = _run_reservoir(
+            n_weeks, releases, stored_volumes[r], evaporations[r],
+            inflows[r], demands[r], storages[r], slopes[r], intercepts[r],
+            capacities[r])
+
+    return unfulfilled_demand
+
+
+@njit(["f8[::1](i8, {0}[:, :, ::1], {0}[:, :, ::1], {0}[:, :, ::1], "
+       "{0}[:, :, ::1], f8[:, ::1], f8[:, ::1], f8[:, ::1], f8[::1])".format(t)
+       for t in _SERIES_TYPES], cache=True, parallel=True)
+def _run_ensemble(n_weeks, stored_volumes, evaporations, inflows, demands,
+                  storages, slopes, intercepts, capacities):
+    """Compiled mass balance of independent chains of reservoirs in series,
+    with chains run in parallel.
+
+    Arguments:
+        n_weeks {int} -- number of weeks to simulate
+        stored_volumes {3D numpy array} -- stored volumes indexed by chain,
+            reservoir and week, updated in place
+        evaporations {3D numpy array} -- evaporations indexed by chain,
+            reservoir and week
+        inflows {3D numpy array} -- inflows indexed by chain, reservoir and
+            week
+        demands {3D numpy array} -- demands indexed by chain, reservoir and
+            week
+        storages {2D numpy array} -- curve storages, one row per reservoir
+        slopes {2D numpy array} -- curve segment slopes, one row per
+            reservoir
+        intercepts {2D numpy array} -- curve segment intercepts, one row per
+            reservoir
+        capacities {1D numpy array} -- reservoir capacities
+
+    Returns:
+        {1D numpy array} -- unfulfilled demand of the last reservoir in the
+                            last week of each chain
+    """
+    n_chains = stored_volumes.shape[0]
+    unfulfilled_demands = np.empty(n_chains)
+
+    for chain in prange(n_chains):
+        unfulfilled_demands[chain] = _run_mass_balance(
+            n_weeks, stored_volumes[chain], evaporations[chain],
+            inflows[chain], demands[chain], storages, slopes, intercepts,
+            capacities)
+
+    return unfulfilled_demands
+
+
+def _curve_segments(storage_area_curve):
+    """Validate a storage vs. area curve and compute its segments.
+
+    Arguments:
+        storage_area_curve {2D numpy matrix} -- Matrix with a
+        row of storages and a row of areas
+
+    Returns:
+        1D numpy array, 1D numpy array, 1D numpy array -- curve storages,
+            area slope and area intercept of each curve segment
+    """
+    storage_area_curve = np.ascontiguousarray(storage_area_curve,
+                                              dtype=np.float64)
+    if storage_area_curve.ndim != 2 or storage_area_curve.shape[0] != 2 or\
+            storage_area_curve.shape[1] < 2:
+        print("Storage vs. area curve must have 2 rows and at least 2 "
+              "points, but had shape {}.".format(storage_area_curve.shape))
+        raise ValueError
+
+    storages, areas = storage_area_curve
+    if np.any(np.diff(storages) <= 0.):
+        print("Curve storages must be strictly increasing, but were "
+              "{}.".format(storages))
+        raise ValueError
+
+    slopes = np.diff(areas) / np.diff(storages)
+    intercepts = areas[:-1] - slopes * storages[:-1]
+
+    return storages, slopes, intercepts
 
 
 class Reservoir:
     __capacity = -1
     __storage_area_curve = np.array([[], []])
+    __storages = np.array([])
+    __slopes = np.array([])
+    __intercepts = np.array([])
     __evaporation_series = np.array([])
     __inflow_series = np.array([])
     __demand_series = np.array([])
     __stored_volume = np.array([])
 
-    def __init__(self, storage_area_curve, evaporations, inflows, demands):
+    def __init__(self, storage_area_curve, evaporations, inflows, demands,
+                 dtype=np.float64):
         """ Constructor for reservoir class
 
         Arguments:
@@ -19,19 +233,36 @@ class Reservoir:
             evaporations {array/list} -- array of evaporations
             inflows {array/list} -- array of inflows
             demands {array/list} -- array of demands
+            dtype {numpy dtype} -- dtype of the stored volume, evaporation,
+                inflow and demand series, np.float64 or np.float32
+                (default: {np.float64})
         """
 
-        self.__storage_area_curve = storage_area_curve
-        assert(storage_area_curve.shape[0] == 2)
-        assert(len(storage_area_curve[0]) == len(storage_area_curve[1]))
+        # Validate inputs once here so the compiled kernels need no checks.
+        self.__storage_area_curve = np.ascontiguousarray(storage_area_curve,
+                                                         dtype=np.float64)
+        self.__storages, self.__slopes, self.__intercepts =\
+            _curve_segments(self.__storage_area_curve)
 
-        self.__capacity = storage_area_curve[0, -1]
+        if not len(evaporations) == len(inflows) == len(demands):
+            print("Evaporation, inflow and demand series must have the same "
+                  "length, but had {}, {} and {}.".format(
+                      len(evaporations), len(inflows), len(demands)))
+            raise ValueError
+
+        if np.dtype(dtype) not in [np.dtype(t) for t in _SERIES_TYPES]:
+            print("Series dtype must be one of {}, but was {}.".format(
+                _SERIES_TYPES, np.dtype(dtype)))
+            raise ValueError
+
+        self.__capacity = float(self.__storages[-1])
  
         n_weeks = len(demands)
-        self.__stored_volume = np.ones(n_weeks, dtype=float) * self.__capacity
-        self.__evaporation_series = evaporations
-        self.__inflow_series = inflows
-        self.__demand_series = demands
+        self.__stored_volume = np.full(n_weeks, self.__capacity, dtype=dtype)
+        self.__evaporation_series = np.ascontiguousarray(evaporations,
+                                                         dtype=dtype)
+        self.__inflow_series = np.ascontiguousarray(inflows, dtype=dtype)
+        self.__demand_series = np.ascontiguousarray(demands, dtype=dtype)
  
     def calculate_area(self, stored_volume):
         """ Calculates reservoir area based on its storage vs. area curve
@@ -43,23 +274,13 @@ class Reservoir:
             float -- reservoir area
         """
 
-        storage_area_curve_T = self.__storage_area_curve.T .astype(float)
-
         if stored_volume > self.__capacity:
             print("Storage volume {} greater than capacity {}.".format(
                 stored_volume, self.__capacity))
             raise ValueError
 
-        for i in range(1, len(storage_area_curve_T)):
-            s, a = storage_area_curve_T[i]
-            # the &st; below needs to be replace with "smaller than" symbol. 
-            # WordPress code highlighter has a bug that was distorting the 
-            # code because of this "smaller than."
-            if stored_volume < s:
-                sm, am = storage_area_curve_T[i - 1]
-                return am + (stored_volume - sm) / (s - sm) * (a - am)
-
-        return a
+        return float(_calculate_area(stored_volume, self.__storages,
+                                     self.__slopes, self.__intercepts))
 
     def mass_balance(self, upstream_flow, week):
         """ Perform mass balance on reservoir
@@ -78,23 +299,11 @@ class Reservoir:
             print("Week must be >= 1, but was {}.".format(week))
             raise ValueError
 
-        evaporation = self.__evaporation_series[week] *\
-            self.calculate_area(self.__stored_volume[week - 1])
-        new_stored_volume = self.__stored_volume[week - 1] + upstream_flow +\
-            self.__inflow_series[week] - evaporation +\
-            self.__demand_series[week]
-
-        release = 0
-        unfulfilled_demand = 0
-
-        if (new_stored_volume > self.__capacity):
-            release = new_stored_volume - self.__capacity
-            new_stored_volume = self.__capacity
-        elif (new_stored_volume < 0.):
-            unfulfilled_demand = -new_stored_volume
-            new_stored_volume = 0.
-
-        self.__stored_volume[week] = new_stored_volume
+        release, unfulfilled_demand, self.__stored_volume[week] = _step(
+            self.__stored_volume[week - 1], upstream_flow,
+            self.__evaporation_series[week], self.__inflow_series[week],
+            self.__demand_series[week], self.__storages, self.__slopes,
+            self.__intercepts, self.__capacity)
 
         return release, unfulfilled_demand
 
@@ -106,6 +315,103 @@ class Reservoir:
         """
         return self.__stored_volume
 
+    def _run(self, n_weeks, releases):
+        """Run the compiled mass balance of the reservoir over all weeks.
+
+        Arguments:
+            n_weeks {int} -- Number of weeks to simulate
+            releases {1D numpy array} -- releases of the upstream reservoir,
+                overwritten in place by the releases of this reservoir
+
+        Returns:
+            float -- unfulfilled demand in the last week
+        """
+        return _run_reservoir(n_weeks, releases, self.__stored_volume,
+                              self.__evaporation_series, self.__inflow_series,
+                              self.__demand_series, self.__storages,
+                              self.__slopes, self.__intercepts,
+                              self.__capacity)
+
+
+def _pad_curves(curves):
+    """Stack curve rows of different lengths by repeating their last entry.
+
+    Arguments:
+        curves {list of 1D numpy arrays} -- curve rows
+
+    Returns:
+        {2D numpy array} -- curve rows padded to the longest one
+    """
+    n_points = max(len(curve) for curve in curves)
+    return np.array([np.pad(curve, (0, n_points - len(curve)), mode="edge")
+                     for curve in curves])
+
+
+class ReservoirSystem:
+    __reservoirs = []
+    __n_weeks = 0
+
+    def __init__(self, reservoirs):
+        """ Constructor for reservoir system class. The system runs the
+        reservoirs directly on their own series, so arrays obtained from
+        them keep seeing the results and a reservoir may belong to several
+        systems.
+
+        Arguments:
+            reservoirs {List of Reservoir} -- list of reservoirs in the
+                order they are connected
+        """
+
+        if len(reservoirs) == 0:
+            print("A reservoir system needs at least one reservoir.")
+            raise ValueError
+
+        stored_volume = reservoirs[0].get_stored_volume_series()
+        n_weeks, dtype = len(stored_volume), stored_volume.dtype
+        for reservoir in reservoirs:
+            stored_volume = reservoir.get_stored_volume_series()
+            if len(stored_volume) != n_weeks or stored_volume.dtype != dtype:
+                print("All reservoirs must have {} weeks of {} data.".format(
+                    n_weeks, dtype))
+                raise ValueError
+
+        self.__reservoirs = list(reservoirs)
+        self.__n_weeks = n_weeks
+
+    def run(self, n_weeks):
+        """Run mass balance on all reservoirs.
+
+        Arguments:
+            n_weeks {int} -- Number of weeks to simulate
+
+        Returns:
+            float -- unfulfilled demand of the last reservoir in the last
+                     week
+        """
+        n_weeks = max(n_weeks, 0)
+        if n_weeks > self.__n_weeks:
+            print("Cannot simulate {} weeks with {} weeks of data.".format(
+                n_weeks, self.__n_weeks))
+            raise ValueError
+
+        # Each reservoir overwrites the releases it received from upstream
+        # by its own, which the next reservoir in the series then reads.
+        releases = np.zeros(n_weeks)
+        for reservoir in self.__reservoirs:
+            unfulfilled_demand = reservoir._run(n_weeks, releases)
+
+        return unfulfilled_demand
+
+    def get_stored_volumes(self):
+        """Return stored volume time series of all reservoirs
+
+        Returns:
+            List of Numpy Array -- stored volumes over time of each
+                                   reservoir, sharing their memory.
+        """
+        return [reservoir.get_stored_volume_series()
+                for reservoir in self.__reservoirs]
+
 
 def run_mass_balance(reservoirs, n_weeks):
     """Run mass balance.
@@ -116,17 +422,70 @@ def run_mass_balance(reservoirs, n_weeks):
         n_weeks {int} -- Number of weeks to simulate
 
     """
-    for week in range(1, n_weeks):
-        release, unfulfilled_demand, total_unfulfilled_demand = 0, 0, 0
-        for reservoir in reservoirs:
-            release, unfulfilled_demand = reservoir.mass_balance(release, week)
-            total_unfulfilled_demand += unfulfilled_demand
+    if len(reservoirs) == 0:
+        return
+
+    unfulfilled_demand = ReservoirSystem(reservoirs).run(n_weeks)
 
     if unfulfilled_demand > 0:
         print("Total unfulfilled demand of {}".format(unfulfilled_demand))
 
 
-def generate_streamflow(n_weeks, sin_amplitude, log_mu, log_sigma):
+def run_ensemble(storage_area_curves, evaporations, inflows, demands,
+                 n_weeks, dtype=np.float64):
+    """Run mass balance on an ensemble of independent chains of reservoirs
+    in series (e.g. Monte Carlo realizations), in parallel across chains.
+    All chains share the same reservoirs and start full.
+
+    Arguments:
+        storage_area_curves {List of 2D numpy matrix} -- storage vs. area
+            curve of each reservoir, in the order they are connected
+        evaporations {3D numpy array} -- evaporations indexed by chain,
+            reservoir and week
+        inflows {3D numpy array} -- inflows indexed by chain, reservoir and
+            week
+        demands {3D numpy array} -- demands indexed by chain, reservoir and
+            week
+        n_weeks {int} -- Number of weeks to simulate
+        dtype {numpy dtype} -- dtype of the series, np.float64 or
+            np.float32 (default: {np.float64})
+
+    Returns:
+        3D numpy array, 1D numpy array -- stored volumes indexed by chain,
+            reservoir and week, and unfulfilled demand of the last
+            reservoir in the last week of each chain
+    """
+    n_weeks = max(n_weeks, 0)
+    evaporations = np.ascontiguousarray(evaporations, dtype=dtype)
+    inflows = np.ascontiguousarray(inflows, dtype=dtype)
+    demands = np.ascontiguousarray(demands, dtype=dtype)
+    if len(storage_area_curves) == 0 or evaporations.ndim != 3 or\
+            not evaporations.shape == inflows.shape == demands.shape or\
+            evaporations.shape[0] == 0 or\
+            evaporations.shape[1] != len(storage_area_curves) or\
+            evaporations.shape[2] < n_weeks:
+        print("Series must be shaped (>= 1, {}, >= {}) alike for at least "
+              "one reservoir, but were {}, {} and {}.".format(
+                  len(storage_area_curves), n_weeks, evaporations.shape,
+                  inflows.shape, demands.shape))
+        raise ValueError
+
+    storages, slopes, intercepts = zip(*[_curve_segments(curve)
+                                         for curve in storage_area_curves])
+    capacities = np.array([s[-1] for s in storages])
+
+    stored_volumes = np.empty(evaporations.shape, dtype=dtype)
+    stored_volumes[:] = capacities[:, np.newaxis]
+
+    unfulfilled_demands = _run_ensemble(
+        n_weeks, stored_volumes, evaporations, inflows, demands,
+        _pad_curves(storages), _pad_curves(slopes), _pad_curves(intercepts),
+        capacities)
+
+    return stored_volumes, unfulfilled_demands
+
+
+def generate_streamflow(n_weeks, sin_amplitude, log_mu, log_sigma, rng=None):
     """Log-normally distributed stream flow generator. Varies mean with sin(t).
 
     Arguments:
@@ -134,36 +493,38 @@ def generate_streamflow(n_weeks, sin_amplitude, log_mu, log_sigma):
         sin_amplitude {double} -- amplitude of log-mean sinusoid fluctuation
         log_mu {double} -- mean log-mean
         log_sigma {double} -- log-sigma
+        rng {numpy Generator} -- random number generator, a new unseeded
+            one is used if None (default: {None})
 
     Returns:
         {Numpy array} -- stream flow series
 
     """
-    streamflows = np.zeros(n_weeks)
-
-    for i in range(n_weeks):
-        # Transform standard normal into normal with specified sigma and mu.
-        streamflow = np.random.randn() * log_mu + log_sigma *\
-            (1. + sin_amplitude * np.sin(2. * np.pi / 52 * (i % 52)))
-        streamflows[i] = np.exp(streamflow)
-
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # Transform standard normals into normals with specified sigma and mu.
+    seasonality = 1. + sin_amplitude * np.resize(_SEASONAL_SIN, n_weeks)
+    streamflows = rng.standard_normal(n_weeks, dtype=np.float64) * log_mu +\
+        log_sigma * seasonality
+    np.exp(streamflows, out=streamflows)
     return streamflows
 
 
 if __name__ == "__main__":
-    np.random.seed(0)
+    rng = np.random.default_rng(0)
     n_weeks = 522
     sin_amplitude, log_mean, log_std = 1., 2.1, 1.8
     streamflows1 = generate_streamflow(n_weeks, sin_amplitude,
-                                       log_mean, log_std)
+                                       log_mean, log_std, rng)
     streamflows2 = generate_streamflow(n_weeks, sin_amplitude,
-                                       log_mean / 2, log_std)
+                                       log_mean / 2, log_std, rng)
     storage_area_curve = np.array([[0, 1000, 3000, 4000], [0, 400, 600, 900]])
 
-    reservoir1 = Reservoir(storage_area_curve, np.random.rand(n_weeks) / 8,
-                           streamflows1, np.random.rand(n_weeks) * 25)
-    reservoir2 = Reservoir(storage_area_curve, np.random.rand(n_weeks) / 8,
-                           streamflows2, np.random.rand(n_weeks) * 25)
+    reservoir1 = Reservoir(storage_area_curve, rng.random(n_weeks) / 8,
+                           streamflows1, rng.random(n_weeks) * 25)
+    reservoir2 = Reservoir(storage_area_curve, rng.random(n_weeks) / 8,
+                           streamflows2, rng.random(n_weeks) * 25)
 
     reservoirs = [reservoir1, reservoir2]
     run_mass_balance(reservoirs, n_weeks)
@@ -1,7 +1,7 @@
-from reservoir_mass_balance import Reservoir, generate_streamflow
+from reservoir_mass_balance import Reservoir, generate_streamflow,\
+    run_mass_balance, run_ensemble, ReservoirSystem
 import numpy as np
 import pytest
-np.random.seed(0)
 
 def test_calculate_area():
     """Test reservoir area calculation, mass balance, and exceptions.
@@ -20,6 +20,18 @@ def test_calculate_area():
     assert reservoir1.calculate_area(650) == 500
     assert reservoir1.calculate_area(1000) == 900
 
+    # Test float32 mass balance against float64 on separate reservoirs
+    reservoirs = [Reservoir(storage_area_curve, evaporation, inflows,
+                            demands, dtype=dtype)
+                  for dtype in [np.float64, np.float32]]
+    for week in [1, 2]:
+        balance64, balance32 = [reservoir.mass_balance(100, week)
+                                for reservoir in reservoirs]
+        assert balance32 == pytest.approx(balance64, rel=1e-5)
+    assert reservoirs[1].get_stored_volume_series().dtype == np.float32
+    assert reservoirs[1].get_stored_volume_series() == pytest.approx(
+        reservoirs[0].get_stored_volume_series(), rel=1e-5)
+
     # Test mass balance
     inflow = 100
     outlfow_test, _ = reservoir1.mass_balance(inflow, 1)
@@ -36,16 +48,175 @@ def test_calculate_area():
         reservoir1.mass_balance(0, 0)
 
 
+def test_calculate_area_long_curve():
+    """Test area calculation against np.interp on a realistic-length curve.
+    """
+    storages = np.linspace(0., 4000., 40) ** 1.5 / 4000. ** 0.5
+    areas = np.sqrt(storages) * 15.
+    reservoir = Reservoir(np.array([storages, areas]), [0.] * 3, [0.] * 3,
+                          [0.] * 3)
+
+    for stored_volume in np.linspace(0., storages[-1], 1001):
+        assert reservoir.calculate_area(stored_volume) == pytest.approx(
+            np.interp(stored_volume, storages, areas))
+
+
+def test_run_ensemble():
+    """Test that each ensemble chain matches a serial run of its reservoirs.
+    """
+    n_chains, n_weeks = 8, 522
+    storage_area_curves = [
+        np.array([[0, 1000, 3000, 4000], [0, 400, 600, 900]]),
+        np.array([[0, 500, 800, 1000, 2000], [0, 400, 600, 900, 1000]])]
+    rng = np.random.default_rng(0)
+    shape = (n_chains, len(storage_area_curves), n_weeks)
+    evaporations = rng.random(shape) / 8
+    inflows = np.exp(rng.standard_normal(shape) * 1.8 + 2.1)
+    demands = -rng.random(shape) * 25
+
+    stored_volumes, _ = run_ensemble(storage_area_curves, evaporations,
+                                     inflows, demands, n_weeks)
+
+    for chain in range(n_chains):
+        reservoirs = [Reservoir(curve, evaporations[chain, r],
+                                inflows[chain, r], demands[chain, r])
+                      for r, curve in enumerate(storage_area_curves)]
+        run_mass_balance(reservoirs, n_weeks)
+        for r, reservoir in enumerate(reservoirs):
+            assert stored_volumes[chain, r] == pytest.approx(
+                reservoir.get_stored_volume_series())
+
+    with pytest.raises(ValueError):
+        run_ensemble(storage_area_curves, evaporations, inflows, demands,
+                     n_weeks + 1)
+    with pytest.raises(ValueError):
+        run_ensemble(storage_area_curves, evaporations[:0], inflows[:0],
+                     demands[:0], n_weeks)
+    with pytest.raises(ValueError):
+        run_ensemble([], evaporations[:, :0], inflows[:, :0], demands[:, :0],
+                     n_weeks)
+
+
+def test_invalid_reservoir():
+    """Test that invalid curves and series are rejected on construction.
+    """
+    series = [0.] * 3
+
+    with pytest.raises(ValueError):
+        Reservoir(np.array([0, 500, 800]), series, series, series)
+    with pytest.raises(ValueError):
+        Reservoir(np.array([[0, 500, 500], [0, 400, 600]]), series, series,
+                  series)
+    with pytest.raises(ValueError):
+        Reservoir(np.array([[0, 500, 800], [0, 400, 600]]), series[:2],
+                  series, series)
+    with pytest.raises(ValueError):
+        Reservoir(np.array([[0, 500, 800], [0, 400, 600]]), series, series,
+                  series, dtype=np.float16)
+
+
+def test_run_mass_balance_updates_series():
+    """Test that series obtained before a run see its results, also when a
+    reservoir belongs to several systems.
+    """
+    storage_area_curve = np.array([[0, 500, 800, 1000], [0, 400, 600, 900]])
+    series = [[0.05] * 5, [15.] * 5, [-200.] * 5]
+
+    reservoir = Reservoir(storage_area_curve, *series)
+    stored_volume = reservoir.get_stored_volume_series()
+    run_mass_balance([reservoir], 5)
+    assert stored_volume == pytest.approx([1000, 770, 556, 349.13333, 150.168])
+
+    reservoir = Reservoir(storage_area_curve, *series)
+    system = ReservoirSystem([reservoir])
+    ReservoirSystem([reservoir])
+    system.run(5)
+    assert reservoir.get_stored_volume_series() == pytest.approx(
+        [1000, 770, 556, 349.13333, 150.168])
+
+
+def test_reservoir_system():
+    """Test reservoir system runs, memory sharing and exceptions.
+    """
+    n_weeks = 52
+    storage_area_curves = [
+        np.array([[0, 1000, 3000, 4000], [0, 400, 600, 900]]),
+        np.array([[0, 500, 800, 1000, 2000], [0, 400, 600, 900, 1000]])]
+    rng = np.random.default_rng(0)
+    inputs = [(rng.random(n_weeks) / 8,
+               generate_streamflow(n_weeks, 1., 2.1, 1.8, rng),
+               -rng.random(n_weeks) * 50) for _ in storage_area_curves]
+
+    reservoirs = [Reservoir(curve, *series)
+                  for curve, series in zip(storage_area_curves, inputs)]
+    stored_volume = reservoirs[0].get_stored_volume_series()
+    system = ReservoirSystem(reservoirs)
+    system.run(n_weeks)
+
+    # Compare against weekly mass balances of the reservoirs in series.
+    expected = [Reservoir(curve, *series)
+                for curve, series in zip(storage_area_curves, inputs)]
+    for week in range(1, n_weeks):
+        release = 0.
+        for reservoir in expected:
+            release, _ = reservoir.mass_balance(release, week)
+
+    for r, reservoir in enumerate(reservoirs):
+        assert system.get_stored_volumes()[r] is\
+            reservoir.get_stored_volume_series()
+        assert reservoir.get_stored_volume_series() == pytest.approx(
+            expected[r].get_stored_volume_series())
+
+    # Series obtained before the run see its results.
+    assert stored_volume is reservoirs[0].get_stored_volume_series()
+    assert stored_volume.min() < 4000
+
+    with pytest.raises(ValueError):
+        system.run(n_weeks + 1)
+    with pytest.raises(ValueError):
+        ReservoirSystem([reservoirs[0],
+                         Reservoir(storage_area_curves[1],
+                                   *[series[:-1] for series in inputs[1]])])
+    with pytest.raises(ValueError):
+        ReservoirSystem([reservoirs[0],
+                         Reservoir(storage_area_curves[1], *inputs[1],
+                                   dtype=np.float32)])
+
+
 def test_generate_streamflow():
     n_weeks = 100000
     log_mu = 7.8
     log_sigma = 0.5
     sin_amplitude = 1.
     streamflows = generate_streamflow(n_weeks, sin_amplitude,
-                                      log_mu, log_sigma)
+                                      log_mu, log_sigma,
+                                      np.random.default_rng(0))
 
-    whitened_log_mu = (np.log(streamflows[range(0, n_weeks, 52)]) -
+    whitened_log_mu = (np.log(streamflows[::52]) -
                        log_mu) / log_sigma
 
     # Test if whitened mean in log space is 0 +- 0.5
     assert np.mean(whitened_log_mu) == pytest.approx(0., abs=0.05)
+
+
+def test_float32_mass_balance():
+    """Test that float32 series give the same storages as float64 ones.
+    """
+    n_weeks = 522
+    storage_area_curve = np.array([[0, 1000, 3000, 4000], [0, 400, 600, 900]])
+    rng = np.random.default_rng(0)
+    inputs = [(rng.random(n_weeks) / 8,
+               generate_streamflow(n_weeks, 1., 2.1, 1.8, rng),
+               -rng.random(n_weeks) * 25) for _ in range(2)]
+
+    stored_volumes = []
+    for dtype in [np.float64, np.float32]:
+        reservoirs = [Reservoir(storage_area_curve, *series, dtype=dtype)
+                      for series in inputs]
+        run_mass_balance(reservoirs, n_weeks)
+        stored_volumes.append([reservoir.get_stored_volume_series()
+                               for reservoir in reservoirs])
+
+    assert stored_volumes[1][0].dtype == np.float32
+    assert np.array(stored_volumes[1]) == pytest.approx(
+        np.array(stored_volumes[0]), rel=1e-5)